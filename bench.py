@@ -0,0 +1,255 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+from contextlib import redirect_stdout
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, List, Optional
+
+import httpx
+import PIL
+
+import metrics
+import server
+from common import RENDER_VERSION, BlobCache, loadCover, loadFont, loadImage
+from engine import GAMES, DrawBest, Game, textMask, truncateTitle
+from renderer import encodeImage
+
+
+# render and server benchmarks over synthetic payloads built from data.json,
+#   python bench.py --output before.json
+#   python bench.py --baseline before.json
+# results are written as json so runs can be compared
+
+def makeRating(game: Game, song: dict, rng: random.Random) -> dict:
+    difficulty = rng.choice([i for i, name in enumerate(game.difficulties) if name])
+    song_rating = round(rng.uniform(10, 15.5), 1)
+    music = {'music_id': song.get('songId') or '0', 'name': song['title'], 'artist': song['artist']}
+    if game.name == 'chunithm':
+        return {
+            'score': rng.randrange(950000, 1010001),
+            'rating': round(song_rating + rng.uniform(0, 2.15), 2),
+            'song_rating': song_rating,
+            'image_name': song.get('imageName') or '',
+            'version': song.get('version'),
+            'playlog': {
+                'difficulty': difficulty,
+                'is_full_combo': rng.random() < .5,
+                'is_all_justice': rng.random() < .2,
+                'is_clear': True,
+                'judge_miss': rng.randrange(10),
+                'judge_attack': rng.randrange(30),
+                'judge_justice': rng.randrange(100),
+                'judge_critical': rng.randrange(500, 3000),
+                'rank': rng.randrange(len(game.score_ranks)),
+                'music': music,
+            },
+        }
+    return {
+        'difficulty': difficulty,
+        'music': music,
+        'score': rng.randrange(970000, 1010001),
+        'rating': round(song_rating + rng.uniform(0, 2), 3),
+        'song_rating': song_rating,
+        'playlog': {
+            'is_full_combo': rng.random() < .5,
+            'is_full_bell': rng.random() < .5,
+            'is_all_break': rng.random() < .2,
+            'judge_miss': rng.randrange(10),
+            'judge_hit': rng.randrange(30),
+            'judge_break': rng.randrange(100),
+            'judge_critical_break': rng.randrange(500, 3000),
+            'tech_score_rank': rng.randrange(1, len(game.score_ranks) + 1),
+        },
+    }
+
+
+def makePayload(game: Game, rng: random.Random) -> dict:
+    # a random player whose best lists are drawn from the loaded catalog
+    songs = game.catalog.songs
+    best = [makeRating(game, rng.choice(songs), rng) for _ in range(30)]
+    best_new = [makeRating(game, rng.choice(songs), rng) for _ in range(20 if game.name == 'chunithm' else 10)]
+    data = {
+        'user_name': f'bench{rng.randrange(10000):04d}',
+        'level': rng.randrange(1, 100),
+        'best_rating': round(rng.uniform(14, 17), 2),
+        'best_new_rating': round(rng.uniform(14, 17), 2),
+        'best_rating_list': best,
+        'best_new_rating_list': best_new,
+    }
+    if game.name == 'chunithm':
+        data.update(character='bench', rating=rng.randrange(1200, 1760))
+        params = {'show_justice': rng.random() < .5}
+    else:
+        data.update(avatar='bench', rating=rng.randrange(13000, 17500), battle_point=rng.randrange(20000),
+                    calc_rating=round(rng.uniform(13, 17.5), 3))
+        params = {'show_break': rng.random() < .5}
+    return {'data': data, 'params': params}
+
+
+def summarize(samples: List[float]) -> Dict[str, float]:
+    samples = sorted(samples)
+    return {
+        'n': len(samples),
+        'min': samples[0],
+        'median': statistics.median(samples),
+        'mean': statistics.fmean(samples),
+        'p95': samples[min(len(samples) - 1, int(len(samples) * .95))],
+        'max': samples[-1],
+    }
+
+
+def clearCaches(game: Game) -> None:
+    # back to the state of a freshly started process, data.json stays loaded
+    # and images already decoded into the asset store are reused
+    for cache in (game.loadBackground, game.loadCard, game.loadDigits, loadCover, loadImage, loadFont, textMask, truncateTitle):
+        cache.cache_clear()
+
+
+def renderPhases(game: Game, payload: dict) -> Dict[str, float]:
+    with metrics.collect() as timings:
+        with metrics.timed('validate'):
+            payload = game.RequestPayload.parse_obj(payload)
+        with metrics.timed('avatar'):
+            avatar = game.openAvatar(None)
+        img = DrawBest(game, payload.data, payload.params).draw(avatar)
+        with metrics.timed('encode'):
+            encodeImage(img, payload.params)
+        timings.add('total', timings.elapsed())
+    return dict(timings)
+
+
+def benchRender(game: Game, payloads: List[dict], warm: int) -> dict:
+    clearCaches(game)
+    cold = renderPhases(game, payloads[0])
+    runs = [renderPhases(game, payloads[i % len(payloads)]) for i in range(warm)]
+    return {
+        'cold': cold,
+        'warm': {phase: summarize([run[phase] for run in runs]) for phase in cold},
+    }
+
+
+async def benchServer(app, game: Game, payloads: List[dict], concurrency: int) -> dict:
+    # every request carries a different payload so none is served from the
+    # render cache, avatars are read from disk to keep the network out of
+    # the numbers
+    transport = httpx.ASGITransport(app=app)
+    sem = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = 0
+
+    async def run(client: httpx.AsyncClient, payload: dict):
+        nonlocal errors
+        async with sem:
+            start = time.perf_counter()
+            res = await client.post(f'/{game.name}/generate', json=payload)
+            latencies.append(time.perf_counter() - start)
+            errors += res.status_code != 200
+
+    async with httpx.AsyncClient(transport=transport, base_url='http://bench', timeout=None) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(run(client, payload) for payload in payloads))
+        seconds = time.perf_counter() - start
+    return {
+        'concurrency': concurrency,
+        'requests': len(payloads),
+        'errors': errors,
+        'seconds': seconds,
+        'throughput': len(payloads) / seconds,
+        'latency': summarize(latencies),
+    }
+
+
+def localAvatar(game: Game) -> Callable[[str], Awaitable[Optional[bytes]]]:
+    # the fallback image as if it had been downloaded, without an avatar the
+    # server would not cache the renders
+    data = (game.res_dir / 'cover_fallback.webp').read_bytes()
+
+    async def fetch(avatar) -> Optional[bytes]:
+        return data
+    return fetch
+
+
+def compare(results: dict, baseline: dict) -> None:
+    # relative change of the headline numbers, lower is better for times
+    for game, result in results['games'].items():
+        base = baseline.get('games', {}).get(game)
+        if base is None:
+            continue
+        for phase, stats in result['render']['warm'].items():
+            old = base['render']['warm'].get(phase)
+            if old:
+                print(f'{game} warm {phase:<10} {old["median"] * 1000:8.1f}ms -> {stats["median"] * 1000:8.1f}ms  {stats["median"] / old["median"] - 1:+.1%}')
+        old_levels = {run['concurrency']: run for run in base.get('server', [])}
+        for run in result['server']:
+            old = old_levels.get(run['concurrency'])
+            if old:
+                print(f'{game} concurrency {run["concurrency"]:<3} {old["throughput"]:6.2f}/s -> {run["throughput"]:6.2f}/s  {run["throughput"] / old["throughput"] - 1:+.1%}')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='benchmark rating image rendering')
+    parser.add_argument('--game', nargs='+', choices=list(GAMES), default=list(GAMES))
+    parser.add_argument('--warm', type=int, default=10, help='warm renders per game')
+    parser.add_argument('--requests', type=int, default=16, help='requests per concurrency level')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the results to this json file')
+    parser.add_argument('--baseline', help='compare against the results in this json file')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    results = {
+        'meta': {
+            'time': time.time(),
+            'python': sys.version.split()[0],
+            'pillow': PIL.__version__,
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'render_version': RENDER_VERSION,
+            'render_workers': server.renderer.workers,
+            'seed': args.seed,
+        },
+        'games': {},
+    }
+    # the renderers print a line per image, keep stdout for the results
+    with tempfile.TemporaryDirectory() as cache_dir, redirect_stdout(sys.stderr):
+        app = server.createApp()
+        server.renderer.start()
+        try:
+            for name in args.game:
+                game = server.games[name]
+                game.fetchAvatar = localAvatar(game)
+                server.render_caches[name] = BlobCache(Path(cache_dir) / name, server.RENDER_CACHE_TTL, server.RENDER_CACHE_MEMORY, server.RENDER_CACHE_DISK)
+                payloads = [makePayload(game, rng) for _ in range(max(1, args.warm))]
+                results['games'][name] = {
+                    'render': benchRender(game, payloads, max(1, args.warm)),
+                    'server': [],
+                }
+                for level in args.concurrency:
+                    # fresh payloads for every level, the earlier ones are cached by now
+                    payloads = [makePayload(game, rng) for _ in range(args.requests)]
+                    results['games'][name]['server'].append(asyncio.run(benchServer(app, game, payloads, level)))
+        finally:
+            server.renderer.shutdown()
+
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
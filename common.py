@@ -0,0 +1,582 @@
+import aiohttp
+import asyncio
+import hashlib
+import json
+import mmap
+import os
+import re
+import struct
+import tempfile
+import threading
+import time
+
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import cached_property, lru_cache
+from pathlib import Path
+from typing import Awaitable, BinaryIO, Callable, Dict, Hashable, Iterable, Mapping, Optional, Tuple, Union
+from weakref import WeakKeyDictionary
+
+from PIL import Image, ImageFont
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+COVER_SIZE: Tuple[int, int] = (135, 135)
+# a 135x135 RGBA thumbnail is ~72KB, so this bounds the cover cache to ~150MB
+COVER_CACHE_SIZE: int = 2048
+# full-size canvases are ~22MB each, keep only the busiest rating tiers around
+BACKGROUND_CACHE_SIZE: int = 4
+CARD_SIZE: Tuple[int, int] = (416, 170)
+# a card tile is ~280KB
+CARD_CACHE_SIZE: int = 256
+# a rasterized line of text is a coverage mask of a few KB
+TEXT_CACHE_SIZE: int = 4096
+# size of the returned image when the request does not ask for a scale
+OUTPUT_SIZE: Tuple[int, int] = (1760, 2000)
+# part of every render cache key, bump it whenever the rendered output changes
+RENDER_VERSION: int = 1
+# decoded sprites and covers shared by all processes on the host, the file is
+# sparse and only takes up what is used. a size of 0 keeps them per process
+ASSET_STORE: Path = Path(os.environ.get('ASSET_STORE') or Path(__file__).parent / 'static' / 'assets.v1.store')
+ASSET_STORE_SIZE: int = int(os.environ.get('ASSET_STORE_SIZE', 1 << 30))
+
+Buffer = Union[bytes, memoryview]
+
+
+class HttpClient:
+    # one pooled session per event loop instead of a new one for every request
+    def __init__(self, limit: int = 32, timeout: float = 10) -> None:
+        self.limit = limit
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self._sessions: WeakKeyDictionary[asyncio.AbstractEventLoop, aiohttp.ClientSession] = WeakKeyDictionary()
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        loop = asyncio.get_running_loop()
+        sess = self._sessions.get(loop)
+        if sess is None or sess.closed:
+            sess = self._sessions[loop] = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.limit),
+                timeout=self.timeout,
+            )
+        return sess
+
+    async def get(self, url: str, **kwargs) -> bytes:
+        return (await self.fetch(url, **kwargs))[2]
+
+    async def fetch(self, url: str, **kwargs) -> Tuple[int, Mapping[str, str], bytes]:
+        async with self.session.get(url, **kwargs) as res:
+            res.raise_for_status()
+            return res.status, res.headers, await res.read()
+
+    async def close(self) -> None:
+        sess = self._sessions.pop(asyncio.get_running_loop(), None)
+        if sess is not None:
+            await sess.close()
+
+
+def runAsync(coro: Awaitable):
+    # for callers without a loop of their own, the pooled session dies with the loop
+    async def main():
+        try:
+            return await coro
+        finally:
+            await http.close()
+    return asyncio.run(main())
+
+
+http = HttpClient()
+
+
+class BlobCache:
+    # LRU in memory in front of a directory, entries expire after ttl seconds.
+    # both sides are bounded in bytes: put() sweeps expired files out of the
+    # directory every sweep_interval seconds, and the oldest ones as well
+    # once it may have grown past max_disk
+    def __init__(self, directory: Path, ttl: float, max_memory: int = 32 << 20, max_disk: int = 256 << 20, sweep_interval: float = 60) -> None:
+        self.directory = directory
+        self.ttl = ttl
+        self.max_memory = max_memory
+        self.max_disk = max_disk
+        self.sweep_interval = sweep_interval
+        # a lookup is get() then load() on a memory miss, so a miss is only
+        # counted once the disk has been tried too
+        self.hits = 0
+        self.misses = 0
+        # get() runs on the event loop while load() and put() run in threads
+        self._lock = threading.Lock()
+        self._mem: OrderedDict[str, Tuple[float, Buffer]] = OrderedDict()
+        self._size = 0
+        # bytes on disk as of the last sweep plus what has been put since,
+        # the first put() sweeps to find out
+        self._disk = 0
+        self._swept = 0.0
+        self._sweeping = threading.Lock()
+
+    def _path(self, key: str) -> Path:
+        if not re.fullmatch(r'[\w-]{1,128}', key):
+            key = hashlib.sha1(key.encode()).hexdigest()
+        return self.directory / key
+
+    def get(self, key: str) -> Optional[Buffer]:
+        with self._lock:
+            item = self._mem.get(key)
+            if item is not None:
+                if item[0] > time.time():
+                    self._mem.move_to_end(key)
+                    self.hits += 1
+                    return item[1]
+                self._forget(key)
+        return None
+
+    def load(self, key: str) -> Optional[bytes]:
+        # disk lookup, run it off the event loop
+        path = self._path(key)
+        try:
+            expires = path.stat().st_mtime + self.ttl
+            if expires <= time.time():
+                self.misses += 1
+                return None
+            data = path.read_bytes()
+        except OSError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._remember(key, data, expires)
+        return data
+
+    def put(self, key: str, data: Buffer) -> None:
+        # run it off the event loop, it may sweep the directory
+        self._remember(key, data, time.time() + self.ttl)
+        try:
+            writeFileAtomic(self._path(key), data)
+        except OSError as e:
+            print('error', 'cannot cache', key, e)
+            return
+        with self._lock:
+            self._disk += len(data)
+            due = self._disk > self.max_disk or time.time() - self._swept > self.sweep_interval
+        if due:
+            self.sweep()
+
+    def sweep(self) -> None:
+        # removes expired files, then the least recently written ones until
+        # the directory is back under max_disk. several processes may share
+        # the directory, each one sweeps it now and then
+        if not self._sweeping.acquire(blocking=False):
+            return
+        try:
+            now = time.time()
+            files = []
+            try:
+                with os.scandir(self.directory) as it:
+                    for entry in it:
+                        # dot files are writeFileAtomic() writes in progress
+                        if not entry.name.startswith('.') and entry.is_file():
+                            stat = entry.stat()
+                            files.append((stat.st_mtime, stat.st_size, entry.path))
+            except OSError:
+                pass
+            files.sort()
+            total = sum(size for _, size, _ in files)
+            for mtime, size, path in files:
+                if mtime + self.ttl > now and total <= self.max_disk:
+                    break
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    print('error', 'cannot remove', path, e)
+                    continue
+                total -= size
+            with self._lock:
+                self._disk = total
+                self._swept = now
+        finally:
+            self._sweeping.release()
+
+    def _forget(self, key: str) -> None:
+        self._size -= len(self._mem.pop(key)[1])
+
+    def _remember(self, key: str, data: Buffer, expires: float) -> None:
+        with self._lock:
+            if key in self._mem:
+                self._forget(key)
+            # a single entry larger than the whole cache is only kept on disk
+            if len(data) > self.max_memory:
+                return
+            self._mem[key] = (expires, data)
+            self._size += len(data)
+            while self._size > self.max_memory:
+                self._forget(next(iter(self._mem)))
+
+
+class SingleFlight:
+    # calls with the same key while one is already running wait for that one
+    # and get its result or exception instead of doing the work again
+    def __init__(self) -> None:
+        self.shared = 0
+        self._running: Dict[Hashable, asyncio.Task] = {}
+
+    async def run(self, key: Hashable, fn: Callable[[], Awaitable]):
+        task = self._running.get(key)
+        if task is not None and task.get_loop() is asyncio.get_running_loop():
+            self.shared += 1
+        else:
+            task = self._running[key] = asyncio.ensure_future(fn())
+            task.add_done_callback(lambda task: self._done(key, task))
+        # a caller that goes away does not cancel the work for the others
+        return await asyncio.shield(task)
+
+    def _done(self, key: Hashable, task: asyncio.Task) -> None:
+        if self._running.get(key) is task:
+            del self._running[key]
+        if not task.cancelled():
+            task.exception()  # retrieved, in case every caller has gone away
+
+
+@contextmanager
+def fileLock(fd: int):
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    try:
+        yield
+    finally:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+
+
+def tryLock(path: Path) -> Optional[int]:
+    # an exclusive lock on path held until the returned fd is closed (or the
+    # process exits), None when another one holds it. without flock the file
+    # is only opened
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    if fcntl is not None:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return None
+    return fd
+
+
+class AssetStore:
+    # decoded RGBA images appended to one file that every process maps once,
+    # so a render worker wraps what another one already decoded instead of
+    # decoding its own copy. entries are found by key and checked against the
+    # source file's mtime, a changed file just appends a new entry. once the
+    # file is full images stay private to each process, deleting it starts
+    # over (processes that have it mapped keep their copy)
+    HEADER = struct.Struct('=8sIIQ')  # magic, format, unused, end of the last entry
+    ENTRY = struct.Struct('=QIIq')  # key, width, height, source mtime
+    MAGIC = b'OTOASSET'
+    FORMAT = 1
+
+    def __init__(self, path: Path, size: int) -> None:
+        self.path = path
+        self.size = size
+        self._lock = threading.Lock()
+        self._fd: Optional[int] = None
+        self._map: Optional[mmap.mmap] = None
+        self._view: Optional[memoryview] = None
+        self._index: Dict[int, Tuple[int, int, int, int]] = {}
+        self._scanned = self.HEADER.size
+        self._full = False
+
+    def _open(self) -> bool:
+        if self._map is not None:
+            return True
+        if fcntl is None or self.size <= 0:
+            return False
+        fd = None
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            with fileLock(fd):
+                if os.fstat(fd).st_size == 0:
+                    os.ftruncate(fd, self.size)
+                    os.pwrite(fd, self.HEADER.pack(self.MAGIC, self.FORMAT, 0, self.HEADER.size), 0)
+                magic, fmt, _, _ = self.HEADER.unpack(os.pread(fd, self.HEADER.size, 0))
+                if magic != self.MAGIC or fmt != self.FORMAT:
+                    raise ValueError(f'not an asset store of format {self.FORMAT}')
+                self._map = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError, struct.error) as e:
+            print('error', 'asset store disabled', self.path, e)
+            if fd is not None:
+                os.close(fd)
+            self.size = 0
+            return False
+        self._fd = fd
+        self._view = memoryview(self._map)
+        return True
+
+    def _scan(self) -> None:
+        # index the entries other processes have appended since the last look
+        end = self.HEADER.unpack_from(self._map)[3]
+        while self._scanned < end:
+            key, width, height, mtime = self.ENTRY.unpack_from(self._map, self._scanned)
+            self._index[key] = (self._scanned + self.ENTRY.size, width, height, mtime)
+            self._scanned += self.ENTRY.size + width * height * 4
+
+    def _find(self, key: int, mtime: int) -> Optional[Tuple[int, int, int, int]]:
+        entry = self._index.get(key)
+        if entry is None or entry[3] != mtime:
+            self._scan()
+            entry = self._index.get(key)
+        return entry if entry is not None and entry[3] == mtime else None
+
+    def _wrap(self, entry: Tuple[int, int, int, int]) -> Image.Image:
+        offset, width, height, _ = entry
+        return Image.frombuffer('RGBA', (width, height), self._view[offset:offset + width * height * 4], 'raw', 'RGBA', 0, 1)
+
+    def get(self, key: int, mtime: int) -> Optional[Image.Image]:
+        with self._lock:
+            entry = self._open() and self._find(key, mtime)
+        return self._wrap(entry) if entry else None
+
+    def put(self, key: int, mtime: int, img: Image.Image) -> Optional[Image.Image]:
+        # the stored copy, or None when the image could not be stored
+        data = img.tobytes()
+        with self._lock:
+            if self._full or not self._open():
+                return None
+            with fileLock(self._fd):
+                entry = self._find(key, mtime)
+                if entry is None:
+                    end = self.HEADER.unpack_from(self._map)[3]
+                    if end + self.ENTRY.size + len(data) > len(self._map):
+                        print('error', 'asset store full', self.path)
+                        self._full = True
+                        return None
+                    os.pwrite(self._fd, self.ENTRY.pack(key, img.width, img.height, mtime) + data, end)
+                    os.pwrite(self._fd, struct.pack('=Q', end + self.ENTRY.size + len(data)), self.HEADER.size - 8)
+                    entry = self._find(key, mtime)
+        return self._wrap(entry)
+
+
+assets = AssetStore(ASSET_STORE, ASSET_STORE_SIZE)
+
+
+# fields of a data.json song that the renderers and the updater use, the rest
+# (sheets, categories, ...) is dropped when the catalog is compiled
+CATALOG_FIELDS: Tuple[str, ...] = ('songId', 'title', 'artist', 'imageName', 'version')
+# bump whenever the layout of catalog.bin changes, older files get recompiled
+CATALOG_FORMAT: int = 1
+CATALOG_MAGIC: bytes = b'OTOCATLG'
+# magic, format, field count, songs, songs with an id, catalog version and the
+# size and mtime of the data.json it was compiled from, padded to 8 bytes
+CATALOG_HEADER = struct.Struct('=8sHHII40sQQ4x')
+NO_STRING: int = 0xffffffff
+
+
+def compactSong(song: dict) -> dict:
+    return {field: None if song.get(field) is None else str(song[field]) for field in CATALOG_FIELDS}
+
+
+def keyHash(*parts: Optional[str]) -> int:
+    # a missing field hashes like an empty one
+    return int.from_bytes(hashlib.blake2b('\0'.join(part or '' for part in parts).encode(), digest_size=8).digest(), 'little')
+
+
+def compileCatalog(songs: Iterable[dict], source: Tuple[int, int] = (0, 0)) -> bytes:
+    # header, an (offset, length) string ref per field and song, the (title,
+    # artist) and song id indexes as sorted hashes followed by the matching
+    # song numbers, then the utf-8 strings
+    songs = [compactSong(song) for song in songs]
+    version = hashlib.sha1(json.dumps(songs, sort_keys=True).encode()).hexdigest()
+    strings = bytearray()
+    offsets: Dict[bytes, int] = {}
+    records = array('I')
+    for song in songs:
+        for field in CATALOG_FIELDS:
+            if song[field] is None:
+                records.extend((NO_STRING, 0))
+                continue
+            data = song[field].encode()
+            if data not in offsets:
+                offsets[data] = len(strings)
+                strings += data
+            records.extend((offsets[data], len(data)))
+    # sorting by (hash, song) keeps the first of several songs with a key first
+    by_title_artist = sorted((keyHash(song['title'], song['artist']), i) for i, song in enumerate(songs))
+    by_id = sorted((keyHash(song['songId']), i) for i, song in enumerate(songs) if song['songId'] is not None)
+    header = CATALOG_HEADER.pack(CATALOG_MAGIC, CATALOG_FORMAT, len(CATALOG_FIELDS), len(songs), len(by_id), version.encode(), *source)
+    return b''.join([
+        header,
+        records.tobytes(),
+        array('Q', [h for h, _ in by_title_artist]).tobytes(),
+        array('Q', [h for h, _ in by_id]).tobytes(),
+        array('I', [i for _, i in by_title_artist]).tobytes(),
+        array('I', [i for _, i in by_id]).tobytes(),
+        strings,
+    ])
+
+
+class Catalog:
+    # read-only view of a compiled catalog, normally an mmap of catalog.bin so
+    # all processes share its pages and songs are only decoded when looked up.
+    # loadData() and reloadData() open a new one and swap it in with a single
+    # assignment, so a render that grabbed it keeps a consistent view while an
+    # update is running
+    version: str
+    source: Tuple[int, int]
+
+    def __init__(self, data: Buffer) -> None:
+        view = memoryview(data)
+        if len(view) < CATALOG_HEADER.size:
+            raise ValueError('truncated catalog')
+        magic, fmt, fields, count, ids, version, *source = CATALOG_HEADER.unpack_from(view)
+        if magic != CATALOG_MAGIC or fmt != CATALOG_FORMAT or fields != len(CATALOG_FIELDS):
+            raise ValueError('unknown catalog format')
+        records = CATALOG_HEADER.size
+        title_artist_hashes = records + count * fields * 8
+        id_hashes = title_artist_hashes + count * 8
+        title_artist_songs = id_hashes + ids * 8
+        id_songs = title_artist_songs + count * 4
+        strings = id_songs + ids * 4
+        if len(view) < strings:
+            raise ValueError('truncated catalog')
+
+        self.version = version.decode()
+        self.source = tuple(source)
+        self._data = data
+        self._count = count
+        self._records = view[records:title_artist_hashes].cast('I')
+        self._by_title_artist = view[title_artist_hashes:id_hashes].cast('Q'), view[title_artist_songs:id_songs].cast('I')
+        self._by_id = view[id_hashes:title_artist_songs].cast('Q'), view[id_songs:strings].cast('I')
+        self._strings = view[strings:]
+
+    @classmethod
+    def load(cls, path: Path) -> 'Catalog':
+        with open(path, 'rb') as f:
+            return cls(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def __len__(self) -> int:
+        return self._count
+
+    def song(self, index: int) -> dict:
+        refs = self._records[index * len(CATALOG_FIELDS) * 2:(index + 1) * len(CATALOG_FIELDS) * 2]
+        return {
+            field: None if offset == NO_STRING else str(self._strings[offset:offset + length], 'utf-8')
+            for field, offset, length in zip(CATALOG_FIELDS, refs[::2], refs[1::2])
+        }
+
+    @cached_property
+    def songs(self) -> Tuple[dict, ...]:
+        # every song decoded, only the updater and the bench need them all
+        return tuple(self.song(i) for i in range(self._count))
+
+    def _lookup(self, index: Tuple[memoryview, memoryview], key: int, match: Callable[[dict], bool]) -> Optional[dict]:
+        hashes, songs = index
+        i = bisect_left(hashes, key)
+        while i < len(hashes) and hashes[i] == key:
+            song = self.song(songs[i])
+            if match(song):
+                return song
+            i += 1
+        return None
+
+    def find(self, title: str, artist: str) -> Optional[dict]:
+        return self._lookup(self._by_title_artist, keyHash(title, artist), lambda song: song['title'] == title and song['artist'] == artist)
+
+    def findId(self, song_id: str) -> Optional[dict]:
+        return self._lookup(self._by_id, keyHash(song_id), lambda song: song['songId'] == song_id)
+
+
+def loadCatalog(res_dir: Path, songs: Optional[Iterable[dict]] = None) -> Catalog:
+    # catalog.bin when it was compiled from the current data.json, otherwise
+    # it is compiled again from the given songs or data.json. if it cannot be
+    # written the compiled catalog is kept in memory instead
+    path = res_dir / 'catalog.bin'
+    try:
+        stat = (res_dir / 'data.json').stat()
+        source = (stat.st_size, stat.st_mtime_ns)
+    except OSError:
+        source = None
+    if songs is None:
+        try:
+            catalog = Catalog.load(path)
+            if source is None or catalog.source == source:
+                return catalog
+        except (OSError, ValueError):
+            pass
+        with open(res_dir / 'data.json', 'r') as f:
+            songs = json.load(f)["songs"]
+    data = compileCatalog(songs, source or (0, 0))
+    try:
+        writeFileAtomic(path, data)
+        return Catalog.load(path)
+    except OSError as e:
+        print('error', 'cannot write', path, e)
+        return Catalog(data)
+
+
+def outputSize(size: Tuple[int, int], scale: Optional[float] = None) -> Tuple[int, int]:
+    if scale is None:
+        return OUTPUT_SIZE
+    return max(1, round(size[0] * scale)), max(1, round(size[1] * scale))
+
+
+def payloadKey(*parts) -> str:
+    # canonical hash of json-able request data, used as cache key and ETag
+    data = json.dumps([RENDER_VERSION, *parts], sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+@lru_cache(maxsize=None)
+def loadFont(path: str, size: int) -> ImageFont.FreeTypeFont:
+    return ImageFont.truetype(path, size)
+
+
+def decodeImage(path: Path, size: Optional[Tuple[int, int]] = None) -> Image.Image:
+    img = Image.open(path).convert('RGBA')
+    if size:
+        img = img.resize(size)
+    return img
+
+
+def loadDecoded(path: Path, size: Optional[Tuple[int, int]] = None) -> Image.Image:
+    # from the asset store if any process has decoded the file at this size
+    # since it last changed, decoded and stored otherwise
+    mtime = os.stat(path).st_mtime_ns
+    key = keyHash(str(Path(path).resolve()), str(size))
+    img = assets.get(key, mtime)
+    if img is None:
+        img = decodeImage(path, size)
+        img = assets.put(key, mtime, img) or img
+    return img
+
+
+@lru_cache(maxsize=None)
+def loadImage(path: Path, size: Optional[Tuple[int, int]] = None) -> Image.Image:
+    # decoded and resized once, shared by every render: never draw onto the result
+    return loadDecoded(path, size)
+
+
+def writeFileAtomic(path: Path, data: Union[Buffer, Callable[[BinaryIO], None]]) -> None:
+    # readers only ever see the old or the complete new file
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix='.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            if callable(data):
+                data(f)
+            else:
+                f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+@lru_cache(maxsize=COVER_CACHE_SIZE)
+def loadCover(res_dir: Path, image_name: str) -> Image.Image:
+    # covers are kept pre-resized in memory and in the asset store
+    if not image_name or Path(image_name).name != image_name:
+        raise FileNotFoundError(image_name)
+    return loadDecoded(res_dir / 'cover_ori' / image_name, COVER_SIZE)
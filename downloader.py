@@ -0,0 +1,166 @@
+import aiohttp
+import asyncio
+import json
+import os
+
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from common import SingleFlight, compactSong, http, writeFileAtomic
+
+
+DATA_URL: str = 'https://dp4p6x0xfi5o9.cloudfront.net/{}/data.json'
+COVER_URL: str = 'https://dp4p6x0xfi5o9.cloudfront.net/{}/img/cover-m/{}'
+HEADERS: Dict[str, str] = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/131.0.0.0 Safari/537.36",
+    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7"
+}
+
+CONCURRENCY: int = 8
+RETRIES: int = 3
+BACKOFF: float = 1
+TIMEOUT: float = 5
+
+Progress = Callable[[int, int, str, Optional[Exception]], None]
+
+# update jobs running at the same time download a file they both need once
+downloads = SingleFlight()
+
+
+def printProgress(done: int, total: int, url: str, error: Optional[Exception]) -> None:
+    if error is None:
+        print(f'[{done}/{total}]', url)
+    else:
+        print(f'[{done}/{total}]', 'error', error, url)
+
+
+async def download(url: str, path: Path, proxy: Optional[str] = None, retries: int = RETRIES, backoff: float = BACKOFF) -> None:
+    for attempt in range(retries + 1):
+        try:
+            data = await http.get(url, headers=HEADERS, timeout=aiohttp.ClientTimeout(total=TIMEOUT), proxy=proxy)
+            break
+        except aiohttp.ClientResponseError as e:
+            if attempt == retries or (e.status < 500 and e.status != 429):
+                raise
+            await asyncio.sleep(backoff * 2 ** attempt)
+        except Exception:
+            if attempt == retries:
+                raise
+            await asyncio.sleep(backoff * 2 ** attempt)
+    await asyncio.to_thread(writeFileAtomic, path, data)
+
+
+async def downloadFiles(jobs: Iterable[Tuple[str, Path]],
+                        proxy: Optional[str] = None,
+                        concurrency: int = CONCURRENCY,
+                        retries: int = RETRIES,
+                        backoff: float = BACKOFF,
+                        progress: Optional[Progress] = printProgress) -> Dict:
+    jobs = list(jobs)
+    failed: List[str] = []
+    done = 0
+    sem = asyncio.Semaphore(max(1, concurrency))
+
+    async def run(url: str, path: Path):
+        nonlocal done
+        async with sem:
+            error = None
+            try:
+                await downloads.run(path, lambda: download(url, path, proxy, retries, backoff))
+            except Exception as e:
+                error = e
+                failed.append(url)
+            done += 1
+            if progress:
+                progress(done, len(jobs), url, error)
+
+    await asyncio.gather(*(run(url, path) for url, path in jobs))
+    return {'total': len(jobs), 'downloaded': len(jobs) - len(failed), 'failed': failed}
+
+
+def missingCovers(game: str, res_dir: Path, songs: Iterable[dict]) -> List[Tuple[str, Path]]:
+    jobs = {}
+    for song in songs:
+        img = song["imageName"]
+        if img and img not in jobs and not os.path.exists(res_dir / 'cover_ori' / img):
+            jobs[img] = (COVER_URL.format(game, img), res_dir / 'cover_ori' / img)
+    return list(jobs.values())
+
+
+async def downloadCovers(game: str, res_dir: Path, songs: Iterable[dict], proxy: Optional[str] = None, **kwargs) -> Dict:
+    jobs = await asyncio.to_thread(missingCovers, game, res_dir, songs)
+    return await downloadFiles(jobs, proxy, **kwargs)
+
+
+async def fetchData(game: str, res_dir: Path, proxy: Optional[str] = None, full: bool = False) -> Optional[Tuple[bytes, Dict]]:
+    # conditional GET against the validators saved with the last download,
+    # returns the body and its validators for saveData(), or None when the
+    # upstream data.json has not changed
+    meta_path = res_dir / 'data.json.meta'
+    headers = {}
+    if not full and (res_dir / 'data.json').exists():
+        try:
+            meta = json.loads(meta_path.read_text())
+        except (OSError, ValueError):
+            meta = {}
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+
+    status, res_headers, body = await http.fetch(DATA_URL.format(game), headers=headers, proxy=proxy)
+    if status == 304:
+        return None
+    return body, {'etag': res_headers.get('ETag'), 'last_modified': res_headers.get('Last-Modified')}
+
+
+async def saveData(res_dir: Path, body: bytes, meta: Dict) -> None:
+    await asyncio.to_thread(writeFileAtomic, res_dir / 'data.json', body)
+    await asyncio.to_thread(writeFileAtomic, res_dir / 'data.json.meta', json.dumps(meta).encode())
+
+
+def songKey(song: dict) -> str:
+    return song.get('songId') or f'{song["title"]} / {song["artist"]}'
+
+
+def diffSongs(old: Iterable[dict], new: Iterable[dict]) -> Dict[str, List[dict]]:
+    old_songs = {songKey(song): song for song in old}
+    new_songs = {songKey(song): song for song in new}
+    return {
+        'added': [song for key, song in new_songs.items() if key not in old_songs],
+        'removed': [song for key, song in old_songs.items() if key not in new_songs],
+        'changed': [song for key, song in new_songs.items() if key in old_songs and old_songs[key] != song],
+        'replaced': [old_songs[key] for key, song in new_songs.items() if key in old_songs and old_songs[key] != song],
+    }
+
+
+def parseSongs(body: bytes) -> List[dict]:
+    # only the fields the catalog keeps, so changes to anything else do not
+    # count as changed songs
+    return [compactSong(song) for song in json.loads(body)["songs"]]
+
+
+async def syncData(game: str, res_dir: Path, songs: Iterable[dict], proxy: Optional[str] = None, full: bool = False, **kwargs) -> Tuple[Optional[List[dict]], Dict[str, List[dict]], Dict]:
+    # returns the new song list (None if nothing changed), the diff against
+    # the given songs and a summary for the caller. every missing cover of the
+    # current songs is fetched, even when data.json has not changed, so covers
+    # that failed before are retried (checking for them is a stat per song)
+    fetched = await fetchData(game, res_dir, proxy, full)
+    if fetched is None:
+        covers = await downloadCovers(game, res_dir, songs, proxy, **kwargs)
+        return None, {}, {'status': 'not_modified', 'covers': covers}
+    body, meta = fetched
+    new_songs = await asyncio.to_thread(parseSongs, body)
+    diff = await asyncio.to_thread(diffSongs, songs, new_songs)
+    covers = await downloadCovers(game, res_dir, new_songs, proxy, **kwargs)
+    # data.json only changes once its covers are in, right before the caller
+    # compiles the new catalog from the returned songs
+    await saveData(res_dir, body, meta)
+    summary = {
+        'status': 'updated' if any(diff.values()) else 'unchanged',
+        'added': [songKey(song) for song in diff['added']],
+        'removed': [songKey(song) for song in diff['removed']],
+        'changed': [songKey(song) for song in diff['changed']],
+        'covers': covers,
+    }
+    return new_songs, diff, summary
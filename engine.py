@@ -0,0 +1,481 @@
+import aiohttp
+import asyncio
+import importlib
+import os
+import threading
+import time
+
+from abc import ABC, abstractmethod
+from functools import lru_cache
+from io import BytesIO
+from pathlib import Path
+from typing import Dict, List, Literal, NamedTuple, Optional, Tuple, Type, Union
+
+from PIL import Image, ImageDraw
+from pydantic import BaseModel, confloat, conint
+
+from common import BACKGROUND_CACHE_SIZE, CARD_CACHE_SIZE, CARD_SIZE, COVER_SIZE, TEXT_CACHE_SIZE, BlobCache, Catalog, SingleFlight, http, loadCatalog, loadCover, loadFont, loadImage, outputSize, runAsync
+from metrics import timed
+
+
+ROOT: Path = Path(__file__).parent
+STATIC: Path = ROOT / 'static'
+
+FONT_MEIRYO: Path = STATIC / 'meiryo.ttc'
+FONT_SIYUAN: Path = STATIC / 'SourceHanSansSC-Bold.otf'
+FONT_TBFONT: Path = STATIC / 'Torus SemiBold.otf'
+
+# players per batch request, all of their images and the zip are held in memory
+MAX_BATCH: int = 50
+
+# seconds between looks at data.json for an update run by another process
+CATALOG_CHECK_INTERVAL: float = 1
+
+AVATAR_TIMEOUT: float = 5
+AVATAR_TTL: float = 7 * 24 * 3600
+
+# game name -> module defining its Game, a new game only needs an entry here
+GAMES: Dict[str, str] = {
+    'ongeki': 'ongeki_rating',
+    'chunithm': 'chunithm_rating',
+}
+
+Color = Tuple[int, int, int, int]
+# sprite under score/, its size and its position on the card
+Badge = Tuple[str, Tuple[int, int], Tuple[int, int]]
+
+
+class Card(NamedTuple):
+    # everything a song card depends on apart from the player's exact score
+    image_name: Optional[str]
+    difficulty: int
+    title: str
+    version: str
+    badges: Tuple[Badge, ...]
+
+
+class RenderParams(BaseModel):
+    # output: scale is relative to the full canvas, 1 skips the downscale
+    scale: Optional[confloat(gt=0, le=1)]
+    format: Optional[Literal['jpeg', 'webp', 'png']]
+    quality: Optional[conint(ge=1, le=100)]
+    optimize: Optional[bool]
+
+
+@lru_cache(maxsize=TEXT_CACHE_SIZE)
+def textMask(font: str, size: int, text: str, anchor: str, stroke_width: int) -> Tuple[Image.Image, Tuple[int, int]]:
+    # coverage of a line of text and its offset from the anchor point, pasting
+    # it in a colour gives the same pixels as ImageDraw.text
+    ft = loadFont(font, size)
+    left, top, right, bottom = ft.getbbox(text, anchor=anchor, stroke_width=stroke_width)
+    mask = Image.new('L', (max(right - left, 0), max(bottom - top, 0)))
+    ImageDraw.Draw(mask).text((-left, -top), text, 255, ft, anchor, stroke_width=stroke_width, stroke_fill=255)
+    return mask, (left, top)
+
+
+class DrawText:
+    def __init__(self, image: Image.Image, font: Path) -> None:
+        self._im = image
+        self._img = ImageDraw.Draw(image)
+        self._font = str(font)
+
+    def get_box(self, text: str, size: int):
+        return loadFont(self._font, size).getbbox(text)
+
+    def draw(self,
+            pos_x: int,
+            pos_y: int,
+            size: int,
+            text: Union[str, int, float],
+            color: Color = (255, 255, 255, 255),
+            anchor: str = 'lt',
+            stroke_width: int = 0,
+            stroke_fill: Color = (0, 0, 0, 0),
+            multiline: bool = False):
+
+        text = str(text)
+        if multiline or '\n' in text:
+            font = loadFont(self._font, size)
+            self._img.multiline_text((pos_x, pos_y), text, color, font, anchor, stroke_width=stroke_width, stroke_fill=stroke_fill)
+            return
+        # the same labels, scores and titles come up again and again, so they
+        # are rasterized once and pasted, the stroke first as ImageDraw does
+        if stroke_width:
+            self._paste(pos_x, pos_y, size, text, stroke_fill, anchor, stroke_width)
+            if color == stroke_fill:
+                return
+        self._paste(pos_x, pos_y, size, text, color, anchor, 0)
+
+    def _paste(self, pos_x: int, pos_y: int, size: int, text: str, color: Color, anchor: str, stroke_width: int) -> None:
+        mask, (dx, dy) = textMask(self._font, size, text, anchor, stroke_width)
+        if mask.width and mask.height:
+            self._im.paste(color, (pos_x + dx, pos_y + dy), mask)
+
+
+class Game(ABC):
+    # the shared renderer, subclasses in <game>_rating.py fill in the payload
+    # models, the layout constants and the hooks below
+    name: str
+    avatar_url: str
+    avatar_field: str
+    RequestPayload: Type[BaseModel]
+    BatchPayload: Type[BaseModel]
+
+    score_ranks: List[str]
+    difficulties: List[Optional[str]]
+    text_color: List[Optional[Color]]
+    fc_images: List[str]
+    rank_badge_size: Tuple[int, int]
+    fc_badge_size: Tuple[int, int]
+    # upper bounds of the rating tiers, the rating has rating_digits digits
+    # with two of them before the decimal point
+    rating_ranges: List[int]
+    rating_digits: int
+    # top of the best and best new lists, and the distance between card rows
+    list_tops: Tuple[int, int]
+    row_height: int
+
+    def __init__(self) -> None:
+        self.res_dir = STATIC / self.name
+        # nothing is read from disk until it is first needed, see catalog and warmup()
+        self._catalog: Optional[Catalog] = None
+        self._catalog_lock = threading.Lock()
+        self._catalog_checked = 0.0
+        self._catalog_stamp: Optional[Tuple[int, int, int]] = None
+        self.avatars = BlobCache(self.res_dir / 'avatar', AVATAR_TTL)
+        self.avatar_downloads = SingleFlight()
+        # caches per game rather than one lru_cache on the method shared by all
+        self.loadCard = lru_cache(maxsize=CARD_CACHE_SIZE)(self.loadCard)
+        self.loadBackground = lru_cache(maxsize=BACKGROUND_CACHE_SIZE)(self.loadBackground)
+        self.loadDigits = lru_cache(maxsize=None)(self.loadDigits)
+
+    # hooks
+
+    @abstractmethod
+    def cardInfo(self, info, songs: Catalog) -> Card:
+        """The Card for one entry of the payload's best lists."""
+
+    @abstractmethod
+    def judgeText(self, info, params) -> str:
+        """The judgement counts printed at the bottom right of a card."""
+
+    @abstractmethod
+    def summaryText(self, data) -> str:
+        """The line of best list averages printed in the header."""
+
+    def backgroundKey(self, data) -> tuple:
+        return (self.ratingIndex(data),)
+
+    @abstractmethod
+    def drawBackground(self, *key) -> Image.Image:
+        """A new full-size canvas with everything shared by a backgroundKey()."""
+
+    def drawBadges(self, im: Image.Image, data) -> None:
+        # per player sprites pasted over the shared background, for things that
+        # would multiply the number of distinct backgrounds
+        pass
+
+    # data
+
+    @property
+    def catalog(self) -> Catalog:
+        # the catalog is opened on first use rather than at import. server
+        # processes share static/ and the one running an update writes
+        # catalog.bin as its last step, so every CATALOG_CHECK_INTERVAL the
+        # others look at it and map the new one. only the first load may have
+        # to compile data.json
+        now = time.monotonic()
+        if self._catalog is None or now - self._catalog_checked > CATALOG_CHECK_INTERVAL:
+            with self._catalog_lock:
+                if self._catalog is None:
+                    self.loadData()
+                elif now - self._catalog_checked > CATALOG_CHECK_INTERVAL:
+                    self.reopenData()
+                self._catalog_checked = now
+        return self._catalog
+
+    def catalogLoaded(self) -> bool:
+        return self._catalog is not None
+
+    def catalogStamp(self) -> Optional[Tuple[int, int, int]]:
+        try:
+            stat = (self.res_dir / 'catalog.bin').stat()
+        except OSError:
+            return None
+        return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+    def loadData(self) -> None:
+        # stamped before loading, a catalog.bin written meanwhile is mapped
+        # again on the next check rather than missed
+        stamp = self.catalogStamp()
+        self._catalog = loadCatalog(self.res_dir)
+        self._catalog_stamp = stamp
+
+    def reopenData(self) -> None:
+        stamp = self.catalogStamp()
+        if stamp is None or stamp == self._catalog_stamp:
+            return
+        try:
+            catalog = Catalog.load(self.res_dir / 'catalog.bin')
+        except (OSError, ValueError) as e:
+            print('error', 'cannot open catalog', self.name, e)
+            return
+        self._catalog, self._catalog_stamp = catalog, stamp
+
+    def reloadData(self, songs: List[dict]) -> None:
+        self._catalog = loadCatalog(self.res_dir, songs)
+        self._catalog_stamp = self.catalogStamp()
+
+    # resources
+
+    async def fetchAvatar(self, avatar) -> Optional[bytes]:
+        try:
+            data = self.avatars.get(avatar) or await asyncio.to_thread(self.avatars.load, avatar)
+            if data is None:
+                data = await self.avatar_downloads.run(avatar, lambda: self.downloadAvatar(avatar))
+            return data
+        except Exception:
+            return None
+
+    async def downloadAvatar(self, avatar) -> bytes:
+        data = await http.get(self.avatar_url.format(avatar), timeout=aiohttp.ClientTimeout(total=AVATAR_TIMEOUT))
+        Image.open(BytesIO(data))  # only cache what is actually an image
+        await asyncio.to_thread(self.avatars.put, avatar, data)
+        return data
+
+    def openAvatar(self, data: Optional[bytes]) -> Image.Image:
+        if data:
+            try:
+                return Image.open(BytesIO(data))
+            except Exception:
+                pass
+        return loadImage(self.res_dir / 'cover_fallback.webp')
+
+    async def getAvatar(self, avatar) -> Image.Image:
+        return self.openAvatar(await self.fetchAvatar(avatar))
+
+    def getCover(self, image_name: Optional[str]) -> Image.Image:
+        if image_name:
+            try:
+                return loadCover(self.res_dir, image_name)
+            except Exception as e:
+                print('error', image_name, e)
+        return loadImage(self.res_dir / 'cover_fallback.webp', COVER_SIZE)
+
+    def coverMtime(self, image_name: Optional[str]) -> Optional[int]:
+        # part of the card key, so a card drawn with the fallback cover is drawn
+        # again once an update has downloaded the real one
+        if not image_name:
+            return None
+        try:
+            return os.stat(self.res_dir / 'cover_ori' / image_name).st_mtime_ns
+        except (OSError, ValueError):
+            return None
+
+    def loadCard(self, image_name: Optional[str], difficulty: int, title: str, version: str, badges: Tuple[Badge, ...], cover_mtime: Optional[int] = None) -> Image.Image:
+        card = Image.new('RGBA', CARD_SIZE)
+        text = DrawText(card, FONT_SIYUAN)
+        color = self.text_color[difficulty]
+
+        card.alpha_composite(loadImage(self.res_dir / f'pattern_{self.difficulties[difficulty]}.png'), (0, 0))
+        card.alpha_composite(self.getCover(image_name), (5, 5))
+        text.draw(136, 149, 18, version, color, anchor='rm')
+
+        for sprite, size, pos in badges:
+            card.alpha_composite(loadImage(self.res_dir / 'score' / sprite, size), pos)
+
+        text.draw(152, 20, 20, truncateTitle(title), color, anchor='lm')
+        return card
+
+    def loadBackground(self, *key) -> Image.Image:
+        # everything that is the same for all players sharing a background key,
+        # each render starts from a copy of it
+        return self.drawBackground(*key)
+
+    def loadDigits(self, rating_index: int) -> Tuple[Tuple[Image.Image, ...], Tuple[Image.Image, ...]]:
+        # num_<tier>.png is a 4x4 sheet of 34x37 glyphs, the digits and the
+        # decimal point at 12, cut out and scaled to both display sizes once
+        sheet = loadImage(self.res_dir / 'rating' / f'num_{rating_index}.png')
+        glyphs = [sheet.crop((34*i, 37*j, 34*(i+1), 37*(j+1))) for j in range(4) for i in range(4)]
+        return tuple(g.resize((68, 74)) for g in glyphs), tuple(g.resize((45, 49)) for g in glyphs)
+
+    def ratingIndex(self, data) -> int:
+        for i, r in enumerate(self.rating_ranges):
+            if data.rating < r:
+                return i
+        else:
+            return 10
+
+    def warmup(self) -> None:
+        # load the catalog and every shared sprite and font up front instead of
+        # on the first requests
+        self.catalog
+        for name in self.difficulties:
+            if name:
+                loadImage(self.res_dir / f'pattern_{name}.png')
+        for rank in self.score_ranks:
+            loadImage(self.res_dir / 'score' / f'score_{rank}.png', self.rank_badge_size)
+        for name in self.fc_images:
+            loadImage(self.res_dir / 'score' / name, self.fc_badge_size)
+        for i in range(11):
+            self.loadDigits(i)
+        loadImage(self.res_dir / 'rating' / 'level_bg.png')
+        loadImage(self.res_dir / 'name_bg.png')
+        loadImage(self.res_dir / 'extra_bg.png', (454, 50))
+        loadImage(self.res_dir / 'cover_fallback.webp', COVER_SIZE)
+        for font, sizes in ((FONT_MEIRYO, (56,)), (FONT_SIYUAN, (18, 20, 40)), (FONT_TBFONT, (22, 28, 38))):
+            for size in sizes:
+                loadFont(str(font), size)
+
+    def generate(self, data, params, avatar: Optional[Image.Image] = None) -> Image.Image:
+        return self.drawImage(data, params, avatar)[0]
+
+    def drawImage(self, data, params, avatar: Optional[Image.Image] = None) -> Tuple[Image.Image, bool]:
+        # the image and whether it is complete, False when the fallback stood in
+        # for a missing cover. the server fetches the avatar on its own loop
+        # beforehand, so rendering itself never needs an event loop
+        if avatar is None:
+            avatar = runAsync(self.getAvatar(getattr(data, self.avatar_field)))
+        start = time.time()
+        draw = DrawBest(self, data, params)
+        img = draw.draw(avatar)
+        print('generated image for', data.user_name, ' cost ', time.time() - start, ' s')
+        return img, draw.complete
+
+
+def getGame(name: str) -> Game:
+    return importlib.import_module(GAMES[name]).game
+
+
+class DrawBest:
+    def __init__(self, game: Game, data, params) -> None:
+        self.game = game
+        self.data = data
+        self.params = params
+        self.complete = True
+        with timed('background'):
+            self._im = game.loadBackground(*game.backgroundKey(data)).copy()
+        self._mr = DrawText(self._im, FONT_MEIRYO)
+        self._sy = DrawText(self._im, FONT_SIYUAN)
+        self._tb = DrawText(self._im, FONT_TBFONT)
+
+    def whiledraw(self, data: list, height: int = 0) -> None:
+        # y为第一排纵向坐标，dy为各排间距
+        dy = self.game.row_height
+        y = height
+        x = 70
+        songs = self.game.catalog
+        for num, info in enumerate(data):
+            if num % 5 == 0:
+                x = 70
+                y += dy if num != 0 else 0
+            else:
+                x += 416
+
+            card = self.game.cardInfo(info, songs)
+            cover_mtime = self.game.coverMtime(card.image_name)
+            if card.image_name and cover_mtime is None:
+                self.complete = False
+            self._im.alpha_composite(self.game.loadCard(*card, cover_mtime), (x, y))
+
+            color = self.game.text_color[card.difficulty]
+            self._sy.draw(x + 8, y + 149, 18, f'#{num + 1}', color, anchor='lm')
+            self._tb.draw(x + 152, y + 56, 38, f'{info.score}', color, anchor='lm')
+            self._tb.draw(x + 342, y + 132, 22, self.game.judgeText(info, self.params), color, anchor='mm')
+            self._tb.draw(x + 152, y + 132, 22, f'{info.song_rating:.01f} -> {info.rating:.02f}', color, anchor='lm')
+
+    def draw(self, avatar: Optional[Image.Image] = None) -> Image.Image:
+        res_dir = self.game.res_dir
+        with timed('header'):
+            self.game.drawBadges(self._im, self.data)
+            large, small = self.game.loadDigits(self.game.ratingIndex(self.data))
+
+            level = loadImage(res_dir / 'rating' / 'level_bg.png')
+            name_bg = loadImage(res_dir / 'name_bg.png')
+            rating_bg = loadImage(res_dir / 'extra_bg.png', (454, 50))
+
+            try:
+                self._im.alpha_composite(Image.new('RGBA', (203, 203), (255, 255, 255, 255)), (404, 114))
+                self._im.alpha_composite(avatar.convert('RGBA').resize((201, 201)), (405, 115))
+            except Exception:
+                pass
+
+            rating_str = f'{self.data.rating:0{self.game.rating_digits}d}'
+            rating_str = rating_str[0:2] + '.' + rating_str[2:]
+            for n, i in enumerate(rating_str):
+                if n == 0 and i == '0': continue
+                if n < 2:
+                    self._im.alpha_composite(large[int(i)], (760 + 50 * n, 252))
+                elif n == 2:
+                    self._im.alpha_composite(small[12], (858, 271))
+                else:
+                    self._im.alpha_composite(small[int(i)], (790 + 30 * n, 271))
+
+            self._im.alpha_composite(name_bg, (750, 185))
+            self._im.alpha_composite(level, (620, 180))
+            self._im.alpha_composite(rating_bg, (620, 120))
+
+            self._mr.draw(682, 226, 56, self.data.level, (255, 255, 255, 200), 'lm')
+            self._sy.draw(774, 217, 40, self.data.user_name, (0, 0, 0, 255), 'lm')
+            self._tb.draw(847, 141, 28, self.game.summaryText(self.data), (0, 0, 0, 255), 'mm', 3, (255, 255, 255, 255))
+            # self._mr.draw(1100, 2465, 35, f'Designed by Yuri-YuzuChaN & BlueDeer233 & Hieuzest', (0, 50, 100, 255), 'mm', 3, (255, 255, 255, 255))
+
+        with timed('cards'):
+            self.whiledraw(self.data.best_rating_list, self.game.list_tops[0])
+            self.whiledraw(self.data.best_new_rating_list, self.game.list_tops[1])
+
+        # some text is drawn semi-transparent, so the alpha channel has to go
+        # through the resize for the output to stay the same
+        with timed('resize'):
+            img = self._im
+            size = outputSize(img.size, self.params.scale)
+            if size != img.size:
+                img = img.resize(size)
+            img = img.convert('RGB')
+        return img
+
+
+# (last code point, display width) ranges, in order
+CHAR_WIDTHS: List[Tuple[int, int]] = [
+    (126, 1), (159, 0), (687, 1), (710, 0), (711, 1), (727, 0), (733, 1), (879, 0), (1154, 1), (1161, 0),
+    (4347, 1), (4447, 2), (7467, 1), (7521, 0), (8369, 1), (8426, 0), (9000, 1), (9002, 2), (11021, 1),
+    (12350, 2), (12351, 1), (12438, 2), (12442, 0), (19893, 2), (19967, 1), (55203, 2), (63743, 1),
+    (64106, 2), (65039, 1), (65059, 0), (65131, 2), (65279, 1), (65376, 2), (65500, 1), (65510, 2),
+    (120831, 1), (262141, 2), (1114109, 1),
+]
+
+
+def widthTable() -> bytes:
+    # width of every code point, a byte each, so a lookup is a single index
+    table = bytearray()
+    for num, wid in CHAR_WIDTHS:
+        table += bytes([wid]) * (num + 1 - len(table))
+    table += b'\x01' * (0x110000 - len(table))
+    table[0xe] = table[0xf] = 0
+    return bytes(table)
+
+
+CHAR_WIDTH_TABLE: bytes = widthTable()
+
+
+def coloumWidth(s: str) -> int:
+    return sum(CHAR_WIDTH_TABLE[ord(ch)] for ch in s)
+
+
+def changeColumnWidth(s: str, len: int) -> str:
+    res = 0
+    sList = []
+    for ch in s:
+        res += CHAR_WIDTH_TABLE[ord(ch)]
+        if res > len:
+            break
+        sList.append(ch)
+    return ''.join(sList)
+
+
+@lru_cache(maxsize=TEXT_CACHE_SIZE)
+def truncateTitle(title: str, width: int = 20) -> str:
+    # titles wider than width columns are cut short with an ellipsis
+    if coloumWidth(title) > width:
+        return changeColumnWidth(title, width - 1) + '...'
+    return title
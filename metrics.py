@@ -0,0 +1,120 @@
+import time
+
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterator, List, Optional, Tuple
+
+
+# upper bounds in seconds, from a cached sprite lookup to a slow avatar download
+BUCKETS: Tuple[float, ...] = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Timings(Dict[str, float]):
+    # seconds spent in each phase while handling one request, render phases
+    # running in a thread or worker process are merged back into it
+    def __init__(self) -> None:
+        super().__init__()
+        self.start = time.perf_counter()
+
+    def add(self, phase: str, seconds: float) -> None:
+        self[phase] = self.get(phase, 0) + seconds
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.start
+
+    def header(self) -> str:
+        return ', '.join(f'{phase};dur={seconds * 1000:.1f}' for phase, seconds in self.items())
+
+
+_timings: ContextVar[Optional[Timings]] = ContextVar('timings', default=None)
+
+
+@contextmanager
+def collect() -> Iterator[Timings]:
+    timings = Timings()
+    token = _timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _timings.reset(token)
+
+
+@contextmanager
+def timed(phase: str) -> Iterator[None]:
+    # a no-op outside of collect(), so rendering from scripts is unaffected
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings = _timings.get()
+        if timings is not None:
+            timings.add(phase, time.perf_counter() - start)
+
+
+def current() -> Optional[Timings]:
+    return _timings.get()
+
+
+def formatLabels(labels: Labels) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}'
+
+
+def formatMetric(name: str, labels: Labels, value: float) -> str:
+    return f'{name}{formatLabels(labels)} {value:g}'
+
+
+class Histogram:
+    # prometheus histogram, only ever touched from the event loop
+    def __init__(self, name: str, help: str, buckets: Tuple[float, ...] = BUCKETS) -> None:
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self._series: Dict[Labels, List] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+        i = bisect_left(self.buckets, value)
+        if i < len(self.buckets):
+            series[0][i] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        for key, (counts, total, count) in sorted(self._series.items()):
+            cumulative = 0
+            for le, n in zip(self.buckets, counts):
+                cumulative += n
+                lines.append(formatMetric(f'{self.name}_bucket', key + (('le', f'{le:g}'),), cumulative))
+            lines.append(formatMetric(f'{self.name}_bucket', key + (('le', '+Inf'),), count))
+            lines.append(formatMetric(f'{self.name}_sum', key, total))
+            lines.append(formatMetric(f'{self.name}_count', key, count))
+        return lines
+
+
+def cacheMetrics(caches: List[Tuple[Labels, int, int]]) -> List[str]:
+    # (labels, hits, misses) of every cache as hit/miss counters and a ratio
+    lines = [
+        '# HELP rating_cache_hits_total Cache lookups answered from the cache.',
+        '# TYPE rating_cache_hits_total counter',
+    ]
+    lines += [formatMetric('rating_cache_hits_total', labels, hits) for labels, hits, _ in caches]
+    lines += [
+        '# HELP rating_cache_misses_total Cache lookups that had to load or render.',
+        '# TYPE rating_cache_misses_total counter',
+    ]
+    lines += [formatMetric('rating_cache_misses_total', labels, misses) for labels, _, misses in caches]
+    lines += [
+        '# HELP rating_cache_hit_ratio Share of cache lookups answered from the cache.',
+        '# TYPE rating_cache_hit_ratio gauge',
+    ]
+    lines += [formatMetric('rating_cache_hit_ratio', labels, hits / (hits + misses) if hits + misses else 0) for labels, hits, misses in caches]
+    return lines
@@ -0,0 +1,174 @@
+import asyncio
+import os
+
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+from multiprocessing import get_context
+from typing import Dict, List, Optional, Tuple, Union
+
+import metrics
+
+from engine import GAMES, Game, getGame
+
+# 0 renders in threads of the server process, more spreads renders over that
+# many worker processes
+RENDER_WORKERS: int = int(os.environ.get('RENDER_WORKERS', 0))
+# renders allowed to wait or run at once before requests are turned away, 0 is unlimited
+RENDER_QUEUE: int = int(os.environ.get('RENDER_QUEUE', 0))
+
+
+# params.format -> (PIL format, media type, file extension)
+IMAGE_FORMATS: Dict[str, Tuple[str, str, str]] = {
+    'jpeg': ('JPEG', 'image/jpeg', 'jpg'),
+    'webp': ('WEBP', 'image/webp', 'webp'),
+    'png': ('PNG', 'image/png', 'png'),
+}
+DEFAULT_FORMAT: str = 'jpeg'
+
+
+class QueueFull(Exception):
+    pass
+
+
+def negotiateFormat(accept: str) -> str:
+    # best output format for an Accept header, types listed explicitly beat
+    # wildcards at the same q and jpeg wins ties
+    best, best_rank = DEFAULT_FORMAT, (0, 0)
+    quality: Dict[str, float] = {}
+    for item in accept.split(','):
+        media, *options = [part.strip() for part in item.split(';')]
+        q = 1.0
+        for option in options:
+            if option.startswith('q='):
+                try:
+                    q = float(option[2:])
+                except ValueError:
+                    q = 0
+        quality.setdefault(media.lower(), q)
+    for fmt, (_, media, _) in IMAGE_FORMATS.items():
+        if media in quality:
+            rank = (quality[media], 1)
+        else:
+            rank = (quality.get('image/*', quality.get('*/*', 0)), 0)
+        if rank[0] > 0 and rank > best_rank:
+            best, best_rank = fmt, rank
+    return best
+
+
+def encodeImage(img, params) -> memoryview:
+    # a view over the encoder's buffer rather than a copy of it
+    fmt = params.format or DEFAULT_FORMAT
+    output_buffer = BytesIO()
+    if fmt == 'jpeg':
+        img.save(output_buffer, 'JPEG', quality=params.quality or 75, optimize=params.optimize is not False)
+    elif fmt == 'webp':
+        img.save(output_buffer, 'WEBP', quality=params.quality or 80)
+    else:
+        img.save(output_buffer, 'PNG', optimize=bool(params.optimize))
+    return output_buffer.getbuffer()
+
+
+def renderImage(game: Game, data, params, avatar_data: Optional[bytes]) -> Tuple[memoryview, bool, Dict[str, float]]:
+    # the encoded image, whether it is complete (no fallback cover or avatar)
+    # and the time spent in each render phase
+    with metrics.collect() as timings:
+        with metrics.timed('avatar'):
+            avatar = game.openAvatar(avatar_data)
+        img, complete = game.drawImage(data, params, avatar)
+        with metrics.timed('encode'):
+            body = encodeImage(img, params)
+    return body, complete and avatar_data is not None, dict(timings)
+
+
+def initWorker() -> None:
+    # an exception here would break the whole pool, whatever failed to warm
+    # up is loaded on first use instead as in the server process
+    for name in GAMES:
+        try:
+            getGame(name).warmup()
+        except Exception as e:
+            print('error', 'worker warm-up failed', name, e)
+
+
+def renderInWorker(name: str, payload: dict, avatar_data: Optional[bytes], version: str) -> Tuple[bytes, bool, Dict[str, float]]:
+    game = getGame(name)
+    if game.catalog.version != version:
+        # the server has reloaded data.json since this worker last looked
+        game.loadData()
+    payload = game.RequestPayload.parse_obj(payload)
+    # memoryviews cannot be pickled back to the server
+    body, complete, timings = renderImage(game, payload.data, payload.params, avatar_data)
+    return body.tobytes(), complete, timings
+
+
+class Renderer:
+    def __init__(self, workers: int = RENDER_WORKERS, queue: int = RENDER_QUEUE) -> None:
+        self.workers = workers
+        self.queue = queue
+        self.pending = 0
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._warming: List[Future] = []
+
+    def start(self) -> None:
+        if self.workers <= 0 or self._pool is not None:
+            return
+        self._pool = ProcessPoolExecutor(self.workers, mp_context=get_context('spawn'), initializer=initWorker)
+        # spawn and warm up every worker now rather than on the first requests
+        self._warming = [self._pool.submit(int) for _ in range(self.workers)]
+
+    async def ready(self) -> None:
+        # waits until the workers spawned by start() are warmed up, a pool that
+        # broke meanwhile shows in healthy()
+        await asyncio.gather(*(asyncio.wrap_future(f) for f in self._warming), return_exceptions=True)
+
+    def healthy(self) -> bool:
+        # false while the workers are warming up, and once a worker has died
+        # and broken the pool (by the OOM killer, say), which starts new ones
+        if self._pool is not None and self._pool._broken:
+            self.restart(self._pool)
+        return all(f.done() and not f.cancelled() and f.exception() is None for f in self._warming)
+
+    def restart(self, pool: ProcessPoolExecutor) -> None:
+        if self._pool is not pool:
+            return  # already replaced after another render hit the broken pool
+        print('error', 'render workers broken, starting new ones')
+        pool.shutdown(wait=False, cancel_futures=True)
+        self._pool = None
+        self.start()
+
+    def shutdown(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(cancel_futures=True)
+            self._pool = None
+            self._warming = []
+
+    async def render(self, game: Game, payload, avatar_data: Optional[bytes]) -> Tuple[Union[bytes, memoryview], bool]:
+        if self.queue and self.pending >= self.queue:
+            raise QueueFull()
+        self.pending += 1
+        try:
+            if self._pool is None:
+                body, complete, timings = await asyncio.to_thread(renderImage, game, payload.data, payload.params, avatar_data)
+            else:
+                body, complete, timings = await self.renderInPool(game, payload, avatar_data)
+        finally:
+            self.pending -= 1
+        request_timings = metrics.current()
+        if request_timings is not None:
+            for phase, seconds in timings.items():
+                request_timings.add(phase, seconds)
+        return body, complete
+
+    async def renderInPool(self, game: Game, payload, avatar_data: Optional[bytes]) -> Tuple[bytes, bool, Dict[str, float]]:
+        # a dead worker breaks the whole pool, it is replaced and the render
+        # tried once more
+        for attempt in range(2):
+            pool = self._pool
+            try:
+                return await asyncio.get_running_loop().run_in_executor(
+                    pool, renderInWorker, game.name, payload.dict(), avatar_data, game.catalog.version)
+            except BrokenProcessPool:
+                if attempt:
+                    raise
+                self.restart(pool)
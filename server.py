@@ -1,119 +1,415 @@
-import aiohttp
 import asyncio
 import fastapi
 import json
 import os
+import re
+import time
+import uuid
 import uvicorn
+import zipfile
 
 from io import BytesIO
-from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
 
+import metrics
+from common import BlobCache, Buffer, Catalog, SingleFlight, http, loadCover, payloadKey, tryLock, writeFileAtomic
+from downloader import CONCURRENCY, printProgress, syncData
+from engine import GAMES, STATIC, Game, getGame
+from renderer import DEFAULT_FORMAT, IMAGE_FORMATS, QueueFull, Renderer, negotiateFormat
 
-ROOT: Path = Path(__file__).parent
-STATIC: Path = ROOT / 'static'
 
-PROXY = None
-try:
-    with open('static/PROXY', 'r') as f:
-        PROXY = f.read().strip()
-except:
-    pass
+def readProxy() -> Optional[str]:
+    try:
+        with open(STATIC / 'PROXY', 'r') as f:
+            return f.read().strip()
+    except:
+        return None
 
-app = fastapi.FastAPI()
 
+# importing this module reads nothing from disk, createApp() builds the app
+# and its startup hook loads data, sprites and render workers
+renderer = Renderer()
 
-import ongeki_rating as Ongeki
-import chunithm_rating as Chunithm
+games: Dict[str, Game] = {name: getGame(name) for name in GAMES}
 
 
-@app.get('/ongeki/update')
-async def _():
-    RES_DIR: Path = STATIC / 'ongeki'
+async def warmup(served: Iterable[Game]) -> None:
+    # games warm up in parallel threads while the render workers warm up in
+    # their own processes, requests arriving before it is done still work and
+    # load whatever they need on first use
+    start = time.time()
+    try:
+        await asyncio.gather(renderer.ready(), *(asyncio.to_thread(game.warmup) for game in served))
+    except Exception as e:
+        print('error', 'warm-up failed', e)
+        raise
+    print('warmed up in', time.time() - start, 's')
 
-    url = 'https://dp4p6x0xfi5o9.cloudfront.net/ongeki/data.json'
-    async with aiohttp.ClientSession() as sess:
-        async with sess.get(url, proxy = PROXY) as res:
-            with open(RES_DIR / 'data.json', 'wb') as f:
-                f.write(await res.read())
 
-        with open(RES_DIR / 'data.json', 'r') as f:
-            data = json.load(f)
+warmup_task: Optional[asyncio.Task] = None
 
-        async def download(url, path):
-            try:
-                async with sess.get(url, headers = {
-                    "Uesr-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/131.0.0.0 Safari/537.36",
-                    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7"
-                }, timeout = 5, proxy = PROXY) as res:
-                    with open(path, 'wb') as f:
-                        f.write(await res.read())
-            except Exception as e:
-                print('error', e, url)
-
-        for song in data["songs"]:
-            img = song["imageName"]
-            if os.path.exists(RES_DIR / f'cover_ori/{img}'):
-                # print('skip', img)
-                continue
-            url = f'https://dp4p6x0xfi5o9.cloudfront.net/ongeki/img/cover-m/{img}'
-            print(url)
-            await download(url, RES_DIR / f'cover_ori/{img}')
-
-        print('updated, reloading data')
-        Ongeki.loadData()
-
-
-@app.get('/chunithm/update')
-async def _():
-    RES_DIR: Path = STATIC / 'chunithm'
-
-    url = 'https://dp4p6x0xfi5o9.cloudfront.net/chunithm/data.json'
-    async with aiohttp.ClientSession() as sess:
-        async with sess.get(url, proxy = PROXY) as res:
-            with open(RES_DIR / 'data.json', 'wb') as f:
-                f.write(await res.read())
-
-        with open(RES_DIR / 'data.json', 'r') as f:
-            data = json.load(f)
-
-        async def download(url, path):
+
+def readiness() -> dict:
+    if warmup_task is None or not warmup_task.done():
+        return {'ready': False, 'state': 'starting'}
+    if warmup_task.cancelled():
+        return {'ready': False, 'state': 'cancelled'}
+    if warmup_task.exception() is not None:
+        return {'ready': False, 'state': 'failed', 'error': repr(warmup_task.exception())}
+    if not renderer.healthy():
+        return {'ready': False, 'state': 'restarting workers'}
+    return {'ready': True, 'state': 'ready'}
+
+
+class UpdateJob:
+    # the status is saved to update.json, so any server process can answer
+    # for a job another one is running
+    def __init__(self, game: Game) -> None:
+        self.id = uuid.uuid4().hex
+        self.game = game.name
+        self.path = game.res_dir / 'update.json'
+        self.state = 'running'
+        self.started = time.time()
+        self.finished: Optional[float] = None
+        self.done = 0
+        self.total = 0
+        self.summary: Optional[dict] = None
+        self.error: Optional[str] = None
+        self.task: Optional[asyncio.Task] = None
+        self._saved = 0.0
+
+    def progress(self, done: int, total: int, url: str, error: Optional[Exception]) -> None:
+        self.done, self.total = done, total
+        printProgress(done, total, url, error)
+        if time.time() - self._saved > 1:
+            self.save()
+
+    def status(self) -> dict:
+        return {k: getattr(self, k) for k in ('id', 'game', 'state', 'started', 'finished', 'done', 'total', 'summary', 'error')}
+
+    def save(self) -> None:
+        self._saved = time.time()
+        try:
+            writeFileAtomic(self.path, json.dumps(self.status()).encode())
+        except OSError as e:
+            print('error', 'cannot save update status', self.path, e)
+
+
+update_jobs: Dict[str, UpdateJob] = {}
+
+
+def startUpdate(game: Game, full: bool, concurrency: int) -> dict:
+    # updates run in the background, one per game across all server processes,
+    # renders keep using the old catalog until the new snapshot is swapped in
+    job = update_jobs.get(game.name)
+    if job is not None and job.state == 'running':
+        return job.status()
+    lock = tryLock(game.res_dir / 'update.lock')
+    if lock is None:
+        return updateStatus(game)
+    job = update_jobs[game.name] = UpdateJob(game)
+    job.save()
+
+    async def run():
+        try:
+            # decoding every song (or compiling data.json) would block the loop
+            current = await asyncio.to_thread(lambda: game.catalog.songs)
+            songs, _, summary = await syncData(game.name, game.res_dir, current, readProxy(), full, concurrency = concurrency, progress = job.progress)
+            if songs is not None:
+                print('updated, reloading data')
+                await asyncio.to_thread(game.reloadData, songs)
+            job.summary = summary
+            job.state = 'done'
+        except Exception as e:
+            print('error', 'update failed', game.name, e)
+            job.error = repr(e)
+            job.state = 'failed'
+        finally:
+            job.finished = time.time()
+            job.save()
+            os.close(lock)
+
+    job.task = asyncio.create_task(run())
+    return job.status()
+
+
+def updateStatus(game: Game) -> dict:
+    job = update_jobs.get(game.name)
+    if job is not None and job.state == 'running':
+        return job.status()
+    try:
+        status = json.loads((game.res_dir / 'update.json').read_text())
+    except (OSError, ValueError):
+        return job.status() if job is not None else {'game': game.name, 'state': 'idle'}
+    if status.get('state') == 'running':
+        # still running only while some process holds the lock
+        lock = tryLock(game.res_dir / 'update.lock')
+        if lock is not None:
+            os.close(lock)
+            status.update(state='failed', error='interrupted')
+    return status
+
+
+class BufferResponse(fastapi.Response):
+    # sends bytes or a memoryview over the encoder's buffer as is, without
+    # copying it into a new bytes object first
+    def render(self, content) -> Buffer:
+        if isinstance(content, memoryview):
+            return content
+        return super().render(content)
+
+
+# per game, a default jpeg is a few hundred KB and a png at scale 1 several MB
+RENDER_CACHE_MEMORY: int = 64 << 20
+RENDER_CACHE_DISK: int = 1 << 30
+RENDER_CACHE_TTL: float = 24 * 3600
+
+render_caches: Dict[str, BlobCache] = {
+    name: BlobCache(game.res_dir / 'render', RENDER_CACHE_TTL, RENDER_CACHE_MEMORY, RENDER_CACHE_DISK) for name, game in games.items()
+}
+
+
+# bots send the same payload several times in a row, requests identical to a
+# render in progress wait for it and share its result
+render_flights: Dict[str, SingleFlight] = {name: SingleFlight() for name in games}
+
+
+async def loadedCatalog(game: Game) -> Catalog:
+    # the first load may have to compile data.json, keep it off the event loop
+    if not game.catalogLoaded():
+        await asyncio.to_thread(lambda: game.catalog)
+    return game.catalog
+
+
+async def renderCached(game: Game, payload) -> Tuple[Buffer, bool]:
+    # the image and whether it is complete, renders that had to use a
+    # fallback cover or avatar are not cached so the next request tries again
+    key = payloadKey(game.name, payload.dict(), (await loadedCatalog(game)).version)
+    cache = render_caches[game.name]
+    with metrics.timed('cache'):
+        body = cache.get(key) or await asyncio.to_thread(cache.load, key)
+    if body is not None:
+        return body, True
+    return await render_flights[game.name].run(key, lambda: renderMissing(game, payload, key))
+
+
+async def renderMissing(game: Game, payload, key: str) -> Tuple[Buffer, bool]:
+    cache = render_caches[game.name]
+    # may have finished while this request was looking on disk
+    body = cache.get(key)
+    if body is not None:
+        return body, True
+    with metrics.timed('avatar'):
+        avatar = await game.fetchAvatar(getattr(payload.data, game.avatar_field))
+    body, complete = await renderer.render(game, payload, avatar)
+    if complete:
+        await asyncio.to_thread(cache.put, key, body)
+    return body, complete
+
+
+# adds a Server-Timing header with the phases of every render request
+SERVER_TIMING: bool = os.environ.get('SERVER_TIMING', '') not in ('', '0')
+
+phase_seconds = metrics.Histogram('rating_phase_seconds', 'Time spent in each phase of a render request.')
+request_seconds = metrics.Histogram('rating_request_seconds', 'Time to answer a render request.')
+
+
+# path -> (game, endpoint) of the render routes, only these are timed so
+# requests to other paths cannot add label values to the histograms
+timed_routes: Dict[str, Tuple[str, str]] = {}
+
+
+class TimingMiddleware:
+    # plain ASGI rather than @app.middleware, which would re-stream every body
+    def __init__(self, app) -> None:
+        self.app = app
+
+    async def __call__(self, scope, receive, send) -> None:
+        route = timed_routes.get(scope.get('path', '')) if scope['type'] == 'http' else None
+        if route is None:
+            return await self.app(scope, receive, send)
+        game, endpoint = route
+        status = 500
+
+        async def sendTimed(message) -> None:
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+                if SERVER_TIMING:
+                    header = f'{timings.header()}, total;dur={timings.elapsed() * 1000:.1f}'.lstrip(', ')
+                    message = {**message, 'headers': [*message.get('headers', []), (b'server-timing', header.encode())]}
+            await send(message)
+
+        with metrics.collect() as timings:
             try:
-                async with sess.get(url, headers = {
-                    "Uesr-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/131.0.0.0 Safari/537.36",
-                    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7"
-                }, timeout = 5, proxy = PROXY) as res:
-                    with open(path, 'wb') as f:
-                        f.write(await res.read())
-            except Exception as e:
-                print('error', e, url)
-
-        for song in data["songs"]:
-            img = song["imageName"]
-            if os.path.exists(RES_DIR / f'cover_ori/{img}'):
-                # print('skip', img)
-                continue
-            url = f'https://dp4p6x0xfi5o9.cloudfront.net/chunithm/img/cover-m/{img}'
-            print(url)
-            await download(url, RES_DIR / f'cover_ori/{img}')
-
-        print('updated, reloading data')
-        Chunithm.loadData()
-
-
-@app.post('/ongeki/generate')
-async def _generate(data: Ongeki.RequestPayload):
-    img = await asyncio.to_thread(Ongeki.generate, data.data, data.params)
-    output_buffer = BytesIO()
-    img.save(output_buffer, 'JPEG', optimize=True)
-    return fastapi.Response(output_buffer.getvalue(), media_type='image/jpeg')
+                await self.app(scope, receive, sendTimed)
+            finally:
+                for phase, seconds in timings.items():
+                    phase_seconds.observe(seconds, game=game, endpoint=endpoint, phase=phase)
+                request_seconds.observe(timings.elapsed(), game=game, endpoint=endpoint, status=str(status))
+
+
+def markValidated() -> None:
+    # the handler only runs once fastapi has read and validated the body
+    timings = metrics.current()
+    if timings is not None:
+        timings.add('validate', timings.elapsed())
+
+
+def metricsText() -> str:
+    # lru caches are per process: with render workers the sprite, card and
+    # background numbers only cover renders done in the server process
+    caches = [((('cache', 'cover'),), *loadCover.cache_info()[:2])]
+    for name, game in games.items():
+        caches += [
+            ((('cache', 'render'), ('game', name)), render_caches[name].hits, render_caches[name].misses),
+            ((('cache', 'avatar'), ('game', name)), game.avatars.hits, game.avatars.misses),
+            ((('cache', 'card'), ('game', name)), *game.loadCard.cache_info()[:2]),
+            ((('cache', 'background'), ('game', name)), *game.loadBackground.cache_info()[:2]),
+            ((('cache', 'digits'), ('game', name)), *game.loadDigits.cache_info()[:2]),
+        ]
+    lines = phase_seconds.render() + request_seconds.render() + metrics.cacheMetrics(caches) + [
+        '# HELP rating_render_pending Renders waiting or running.',
+        '# TYPE rating_render_pending gauge',
+        metrics.formatMetric('rating_render_pending', (), renderer.pending),
+        '# HELP rating_coalesced_total Requests that waited for an identical one already in progress.',
+        '# TYPE rating_coalesced_total counter',
+    ]
+    for name, game in games.items():
+        lines += [
+            metrics.formatMetric('rating_coalesced_total', (('kind', 'render'), ('game', name)), render_flights[name].shared),
+            metrics.formatMetric('rating_coalesced_total', (('kind', 'avatar'), ('game', name)), game.avatar_downloads.shared),
+        ]
+    return '\n'.join(lines) + '\n'
+
 
+def withFormat(payload, fmt: str):
+    # resolved output format goes into params so it is part of the cache key
+    return payload.copy(update={'params': payload.params.copy(update={'format': fmt})})
 
-@app.post('/chunithm/generate')
-async def _generate(data: Chunithm.RequestPayload):
-    img = await asyncio.to_thread(Chunithm.generate, data.data, data.params)
+
+async def render(game: Game, payload, request: fastapi.Request) -> fastapi.Response:
+    # identical payloads render to identical images as long as the catalog is
+    # the same, so serve them from cache and let clients revalidate by ETag
+    markValidated()
+    fmt = payload.params.format or negotiateFormat(request.headers.get('Accept', ''))
+    payload = withFormat(payload, fmt)
+    etag = f'"{payloadKey(game.name, payload.dict(), (await loadedCatalog(game)).version)}"'
+    headers = {'ETag': etag, 'Vary': 'Accept'}
+    if etag in request.headers.get('If-None-Match', ''):
+        return fastapi.Response(status_code=304, headers=headers)
+    try:
+        body, complete = await renderCached(game, payload)
+    except QueueFull:
+        return fastapi.Response(status_code=503, headers={'Retry-After': '1'})
+    if not complete:
+        # no ETag, so clients do not keep revalidating a fallback image
+        headers = {'Vary': 'Accept', 'Cache-Control': 'no-store'}
+    return BufferResponse(body, media_type=IMAGE_FORMATS[fmt][1], headers=headers)
+
+
+def safeName(name: str) -> str:
+    return re.sub(r'[^\w.-]', '_', name)
+
+
+def zipImages(names: List[str], images: List[Buffer]) -> memoryview:
     output_buffer = BytesIO()
-    img.save(output_buffer, 'JPEG', optimize=True)
-    return fastapi.Response(output_buffer.getvalue(), media_type='image/jpeg')
+    with zipfile.ZipFile(output_buffer, 'w', zipfile.ZIP_STORED) as f:
+        for name, body in zip(names, images):
+            f.writestr(name, body)
+    return output_buffer.getbuffer()
+
+
+async def renderBatch(game: Game, batch) -> fastapi.Response:
+    # one request for a whole group of players, rendered in parallel and
+    # returned as a zip of <index>_<user_name>.<ext>
+    markValidated()
+    fmt = batch.params.format or DEFAULT_FORMAT
+    params = batch.params.copy(update={'format': fmt})
+    await asyncio.to_thread(game.warmup)
+    sem = asyncio.Semaphore(max(1, renderer.workers or os.cpu_count() or 1))
+
+    async def run(data):
+        async with sem:
+            payload = game.RequestPayload(data=data, params=params)
+            return (await renderCached(game, payload))[0]
+
+    tasks = [asyncio.ensure_future(run(data)) for data in batch.data]
+    try:
+        images = await asyncio.gather(*tasks)
+    except QueueFull:
+        return fastapi.Response(status_code=503, headers={'Retry-After': '1'})
+    finally:
+        # once one render has failed the others would be thrown away
+        for task in tasks:
+            task.cancel()
+    names = [f'{i:03d}_{safeName(data.user_name)}.{IMAGE_FORMATS[fmt][2]}' for i, data in enumerate(batch.data)]
+    body = await asyncio.to_thread(zipImages, names, images)
+    return BufferResponse(body, media_type='application/zip', headers={
+        'Content-Disposition': f'attachment; filename="{game.name}.zip"',
+    })
+
+
+def addRoutes(app: fastapi.FastAPI, game: Game, prefix: str) -> None:
+    # the same endpoints for every game, under the given prefix
+
+    @app.get(f'{prefix}/update')
+    async def _(full: bool = False, concurrency: int = CONCURRENCY):
+        return startUpdate(game, full, concurrency)
+
+    @app.get(f'{prefix}/update/status')
+    async def _():
+        return updateStatus(game)
+
+    @app.post(f'{prefix}/generate')
+    async def _generate(data: game.RequestPayload, request: fastapi.Request):
+        return await render(game, data, request)
+
+    @app.post(f'{prefix}/generate_batch')
+    async def _generate(data: game.BatchPayload):
+        return await renderBatch(game, data)
+
+    for endpoint in ('generate', 'generate_batch'):
+        timed_routes[f'{prefix}/{endpoint}'] = (game.name, endpoint)
+
+
+def createApp(standalone: Optional[str] = None) -> fastapi.FastAPI:
+    # every game under /<game>/, or only the standalone one at the root as
+    # served by python <game>_rating.py
+    # for several server processes: uvicorn --factory server:createApp --workers N
+    served = [games[standalone]] if standalone else list(games.values())
+    app = fastapi.FastAPI()
+    app.add_middleware(TimingMiddleware)
+
+    @app.on_event('startup')
+    async def _():
+        global warmup_task
+        renderer.start()
+        warmup_task = asyncio.create_task(warmup(served))
+
+    @app.on_event('shutdown')
+    async def _():
+        if warmup_task is not None:
+            warmup_task.cancel()
+        renderer.shutdown()
+        await http.close()
+
+    @app.get('/ready')
+    async def _():
+        # 503 until warm-up has finished, for load balancers during rolling restarts
+        status = readiness()
+        return fastapi.responses.JSONResponse(status, status_code=200 if status['ready'] else 503)
+
+    @app.get('/metrics')
+    async def _():
+        return fastapi.Response(metricsText(), media_type='text/plain; version=0.0.4')
+
+    for game in served:
+        addRoutes(app, game, '' if standalone else f'/{game.name}')
+    return app
+
 
 # main
-uvicorn.run(app, host='127.0.0.1', port=5150)
+if __name__ == '__main__':
+    uvicorn.run(createApp(), host='127.0.0.1', port=5150)
+
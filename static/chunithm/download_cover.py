@@ -1,7 +1,11 @@
 import json
-import asyncio
-import aiohttp
-import os
+import sys
+
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
+from common import runAsync
+from downloader import CONCURRENCY, downloadCovers
 
 PROXY = None
 try:
@@ -13,27 +17,6 @@ except:
 with open('data.json', 'r') as f:
     data = json.load(f)
 
-async def download(url, path):
-    try:
-        async with sess.get(url, headers = {
-            "Uesr-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/131.0.0.0 Safari/537.36",
-            "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7"
-        }, timeout = 5, proxy = PROXY) as res:
-            with open(path, 'wb') as f:
-                f.write(await res.read())
-    except Exception as e:
-        print('error', e, url)
-
-async def main():
-    global sess
-    async with aiohttp.ClientSession() as sess:
-        for song in data["songs"]:
-            img = song["imageName"]
-            if os.path.exists(f'cover_ori/{img}'):
-                # print('skip', img)
-                continue
-            url = f'https://dp4p6x0xfi5o9.cloudfront.net/chunithm/img/cover-m/{img}'
-            print(url)
-            await download(url, f'cover_ori/{img}')
-
-asyncio.run(main())
\ No newline at end of file
+concurrency = int(sys.argv[1]) if len(sys.argv) > 1 else CONCURRENCY
+summary = runAsync(downloadCovers('chunithm', Path('.'), data["songs"], PROXY, concurrency = concurrency))
+print(summary['downloaded'], 'of', summary['total'], 'covers downloaded')